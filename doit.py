@@ -1,15 +1,74 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import json
 import logging
 import os
+import pickle
 import sys
+import threading
+
+import orjson
 
 import requests
 
-import yaml
+STATUS_FILE = "status.json"
+STATUS_FILE_LEGACY = "status.yaml"
+STATUS_FILE_PICKLE = "status.pkl"
+ETAGS_FILE = "etags.json"
+ETAGS_CACHE_BYTES = 4 * 1024 * 1024
+PER_PAGE = 100
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_PRS_QUERY = """
+query(
+  $owner: String!, $repo: String!, $cursor: String,
+  $org: String!, $withOrg: Boolean!, $check: String!, $withCheck: Boolean!
+) {
+  repository(owner: $owner, name: $repo) {
+    pullRequests(
+      states: OPEN, first: 50, after: $cursor,
+      orderBy: {field: UPDATED_AT, direction: DESC}
+    ) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        updatedAt
+        isDraft
+        author {
+          login
+          ... on User {
+            organization(login: $org) @include(if: $withOrg) { login }
+          }
+        }
+        commits(last: 1) {
+          nodes {
+            commit {
+              oid
+              status @include(if: $withCheck) {
+                context(name: $check) { state createdAt }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# Cached GET responses keyed by URL, revalidated with If-None-Match
+# Loaded on first use only, commands that do not GET anything never touch it
+_etags = None
+_etags_lock = threading.Lock()
 
-STATUS_FILE = "status.yaml"
+# Reuse connections (and TLS sessions) across all requests
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16),
+)
 
 
 def _headers(args):
@@ -21,52 +80,287 @@ def _headers(args):
     return headers
 
 
+def _get_links(header):
+    # Same as requests.Response.links, but for the Link header we have cached
+    links = {}
+    for link in requests.utils.parse_header_links(header or ""):
+        links[link.get("rel") or link.get("url")] = link
+    return links
+
+
 def _get_raw(url, **kwargs):
-    response = requests.get(url, **kwargs)
+    etags = _get_etags()
+    key = requests.Request("GET", url, params=kwargs.get("params")).prepare().url
+    with _etags_lock:
+        cached = etags.get(key)
+    if cached is not None:
+        kwargs["headers"] = {
+            **(kwargs.get("headers") or {}),
+            "If-None-Match": cached["etag"],
+        }
+
+    response = _SESSION.get(url, **kwargs)
+
+    # Not modified responses have no body and do not count against rate limit
+    if response.status_code == 304 and cached is not None:
+        logging.debug(f"Using cached response for {key}")
+        with _etags_lock:
+            if key in etags:
+                etags.move_to_end(key)
+        return cached["body"].encode("utf-8"), _get_links(cached["link"])
+
     if not response.ok:
         raise Exception(
             f"Failed to get reposnse {url}: {response.status_code} {response.text}"
         )
-    return response
 
+    if "ETag" in response.headers:
+        with _etags_lock:
+            etags[key] = {
+                "etag": response.headers["ETag"],
+                "link": response.headers.get("Link"),
+                "body": response.content.decode("utf-8"),
+            }
+            etags.move_to_end(key)
 
-def _get_all(url, **kwargs):
-    while True:
-        response = _get_raw(url, **kwargs)
+    return response.content, response.links
 
-        results = response.json()
-        logging.debug(f"From {url} got {len(response.json())} results")
 
-        for r in results:
-            yield r
+def _get_all(url, prefetch=True, **kwargs):
+    # GitHub defaults to 30 items per page, ask for maximum instead
+    kwargs["params"] = {"per_page": PER_PAGE, **(kwargs.get("params") or {})}
 
-        if "next" in response.links:
-            url = response.links["next"]["url"]
-        else:
-            break
+    content, links = _get_raw(url, **kwargs)
 
+    # Page URLs already contain all the query parameters
+    page_kwargs = {k: v for k, v in kwargs.items() if k != "params"}
 
-def _load_status():
-    if not os.path.isfile(STATUS_FILE):
-        with open(STATUS_FILE, "w+") as fp:
-            yaml.dump({}, fp)
+    # Fetch next page while caller processes current one, but keep just one
+    # request in flight as GitHub secondary rate limits are strict. Callers
+    # that usually stop early turn it off not to waste requests.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            next_url = links["next"]["url"] if "next" in links else None
+            future = None
+            if next_url is not None and prefetch:
+                future = executor.submit(_get_raw, next_url, **page_kwargs)
+
+            results = orjson.loads(content)
+            logging.debug(f"From {url} got {len(results)} results")
+
+            yield from results
 
-    with open(STATUS_FILE, "r+") as fp:
-        data = yaml.load(fp, Loader=yaml.Loader)
+            if next_url is None:
+                break
+            url = next_url
+            if future is not None:
+                content, links = future.result()
+            else:
+                content, links = _get_raw(url, **page_kwargs)
+    finally:
+        # Do not leave worker behind updating ETag cache when caller is done
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _get_last(url, **kwargs):
+    # Jump straight to the last page instead of walking all of them
+    kwargs["params"] = {"per_page": PER_PAGE, **(kwargs.get("params") or {})}
+
+    content, links = _get_raw(url, **kwargs)
+    page_kwargs = {k: v for k, v in kwargs.items() if k != "params"}
+    if "last" in links:
+        content, links = _get_raw(links["last"]["url"], **page_kwargs)
+
+    # Without "last" link we have to walk through the pages one by one
+    while "next" in links:
+        content, links = _get_raw(links["next"]["url"], **page_kwargs)
+
+    return orjson.loads(content)[-1]
+
+
+def _get_all_prs_graphql(args, headers):
+    # One query returns page of PRs including data we would otherwise need
+    # to get with separate REST calls for every PR
+    if args.token is None:
+        raise Exception("GraphQL API needs a token")
+
+    variables = {
+        "owner": args.owner,
+        "repo": args.repo,
+        "cursor": None,
+        "org": args.author_in_org or "",
+        "withOrg": args.author_in_org is not None,
+        "check": args.successful_check or "",
+        "withCheck": args.successful_check is not None,
+    }
+
+    while True:
+        response = _SESSION.post(
+            GRAPHQL_URL,
+            headers=headers,
+            json={"query": GRAPHQL_PRS_QUERY, "variables": variables},
+        )
+        if not response.ok:
+            raise Exception(
+                f"Failed to post to {GRAPHQL_URL}: {response.status_code} {response.text}"
+            )
+        data = orjson.loads(response.content)
+        if "errors" in data:
+            raise Exception(f"GraphQL query failed: {data['errors']}")
+
+        pull_requests = data["data"]["repository"]["pullRequests"]
+        logging.debug(f"From {GRAPHQL_URL} got {len(pull_requests['nodes'])} results")
+
+        # Return PRs in same shape as REST API does
+        for node in pull_requests["nodes"]:
+            author = node["author"] or {"login": "ghost"}
+            commit = node["commits"]["nodes"][0]["commit"]
+            pr = {
+                "number": node["number"],
+                "issue_url": f"https://api.github.com/repos/{args.owner}/{args.repo}/issues/{node['number']}",
+                "updated_at": node["updatedAt"],
+                "user": {"login": author["login"]},
+                "head": {"sha": commit["oid"]},
+                "draft": node["isDraft"],
+            }
+            if args.author_in_org is not None:
+                pr["author_in_org"] = author.get("organization") is not None
+            if args.successful_check is not None:
+                context = (commit["status"] or {}).get("context")
+                pr["successful_check_status"] = (
+                    None
+                    if context is None
+                    else {
+                        "state": context["state"].lower(),
+                        "updated_at": context["createdAt"],
+                    }
+                )
+            yield pr
+
+        if not pull_requests["pageInfo"]["hasNextPage"]:
+            break
+        variables["cursor"] = pull_requests["pageInfo"]["endCursor"]
+
+
+def _get_etags():
+    global _etags
+
+    # Pages might be fetched from a background thread
+    with _etags_lock:
+        if _etags is None:
+            _etags = collections.OrderedDict()
+            if os.path.isfile(ETAGS_FILE):
+                with open(ETAGS_FILE, "rb") as fp:
+                    _etags.update(orjson.loads(fp.read()))
+    return _etags
+
+
+def _dump_etags():
+    # Do not let prefetch worker change the cache while we serialize it
+    with _etags_lock:
+        if _etags is None or len(_etags) == 0:
+            return
+
+        # Drop least recently used responses to keep the file small to load
+        size = sum(len(v["body"]) for v in _etags.values())
+        while size > ETAGS_CACHE_BYTES:
+            _, value = _etags.popitem(last=False)
+            size -= len(value["body"])
+
+        data = orjson.dumps(_etags)
+
+    with open(ETAGS_FILE, "wb") as fp:
+        fp.write(data)
+
+
+def _migrate_status():
+    # Status used to be stored in YAML, convert it to JSON once
+    if os.path.isfile(STATUS_FILE) or not os.path.isfile(STATUS_FILE_LEGACY):
+        return
+
+    # PyYAML is slow to import and only needed here
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+
+    logging.debug(f"Migrating {STATUS_FILE_LEGACY} to {STATUS_FILE}")
+    with open(STATUS_FILE_LEGACY, "r") as fp:
+        data = yaml.load(fp, Loader=Loader)
+
+    _dump_status(data if data is not None else {})
+
+
+def _read_status(st):
+    # Pickle copy of the status loads faster, use it only if it was made from
+    # exactly this JSON file (mtime alone is not enough, e.g. "cp -p" keeps it)
+    if os.path.isfile(STATUS_FILE_PICKLE):
+        try:
+            with open(STATUS_FILE_PICKLE, "rb") as fp:
+                cached = pickle.load(fp)
+            if cached.get("json_stat") == (st.st_mtime_ns, st.st_size):
+                return cached["data"]
+        except (
+            EOFError,
+            pickle.UnpicklingError,
+            ValueError,
+            TypeError,
+            KeyError,
+            IndexError,
+            AttributeError,
+            ImportError,
+        ) as e:
+            # It is just a cache, JSON file has all the data
+            logging.debug(f"Ignoring broken {STATUS_FILE_PICKLE}: {e}")
+
+    with open(STATUS_FILE, "r") as fp:
+        data = json.load(fp)
 
     if data is None:
         data = {}
 
+    _dump_status_pickle(data, st)
     return data
 
 
+def _load_status():
+    _migrate_status()
+
+    if not os.path.isfile(STATUS_FILE):
+        with open(STATUS_FILE, "w") as fp:
+            fp.write("{}\n")
+
+    return _read_status(os.stat(STATUS_FILE))
+
+
 def _dump_status(data):
     with open(STATUS_FILE, "w") as fp:
-        yaml.dump(data, fp)
+        json.dump(data, fp, indent=2, sort_keys=True)
+    _dump_status_pickle(data, os.stat(STATUS_FILE))
+
+
+def _dump_status_pickle(data, st):
+    cached = {"json_stat": (st.st_mtime_ns, st.st_size), "data": data}
+
+    # Never leave half written pickle behind, e.g. when interrupted
+    tmp = f"{STATUS_FILE_PICKLE}.tmp"
+    with open(tmp, "wb") as fp:
+        pickle.dump(cached, fp, protocol=5)
+    os.replace(tmp, STATUS_FILE_PICKLE)
 
 
 def find_pr(args):
     status = _load_status()
+    headers = _headers(args)
+
+    # Single hash lookup per PR instead of digging in status
+    processed_updated_at = {(k, v["updated_at"]) for k, v in status.items()}
+    processed_commits = {
+        (k, v["last_commit_sha"]) for k, v in status.items() if "last_commit_sha" in v
+    }
 
     url = f"https://api.github.com/repos/{args.owner}/{args.repo}/pulls"
     params = {
@@ -75,7 +369,13 @@ def find_pr(args):
         "direction": "desc",
     }
 
-    for pr in _get_all(url, params=params, headers=_headers(args)):
+    if args.graphql:
+        prs = _get_all_prs_graphql(args, headers)
+    else:
+        # We usually stop at one of the first PRs, do not fetch pages ahead
+        prs = _get_all(url, params=params, headers=headers, prefetch=False)
+
+    for pr in prs:
         pr_number = pr["number"]
         pr_issue_url = pr["issue_url"]
         pr_updated_at = pr["updated_at"]
@@ -90,50 +390,61 @@ def find_pr(args):
                 f"PR {pr_number}/{pr_issue_url} last updated at {pr_updated_at} is a draft, skipping it"
             )
 
-        if (
-            pr_issue_url in status
-            and pr_updated_at == status[pr_issue_url]["updated_at"]
-        ):
+        if (pr_issue_url, pr_updated_at) in processed_updated_at:
+            # PRs come sorted by update time, so all the remaining PRs were
+            # last updated before this one we have already processed
+            if args.incremental:
+                logging.debug(
+                    f"PR {pr_number}/{pr_issue_url} last updated at {pr_updated_at} already processed, stopping"
+                )
+                return
             logging.debug(
                 f"PR {pr_number}/{pr_issue_url} last updated at {pr_updated_at} already processed, skipping it"
             )
             continue
 
-        if (
-            pr_issue_url in status
-            and "last_commit_sha" in status[pr_issue_url]
-            and pr_last_commit_sha == status[pr_issue_url]["last_commit_sha"]
-        ):
+        if (pr_issue_url, pr_last_commit_sha) in processed_commits:
             logging.debug(
                 f"PR {pr_number}/{pr_issue_url} last commit {pr_last_commit_sha} already processed, skipping it"
             )
             continue
 
         if args.author_in_org is not None:
-            url = f"https://api.github.com/orgs/{args.author_in_org}/memberships/{pr_user_login}"
-            response = requests.get(url, headers=_headers(args))
-            if (
-                response.status_code != 200
-                or "organization" not in response.json()
-                or args.author_in_org != response.json()["organization"]["login"]
-            ):
+            if "author_in_org" in pr:
+                author_in_org = pr["author_in_org"]
+            else:
+                url = f"https://api.github.com/orgs/{args.author_in_org}/memberships/{pr_user_login}"
+                response = _SESSION.get(url, headers=headers)
+                membership = (
+                    orjson.loads(response.content)
+                    if response.status_code == 200
+                    else {}
+                )
+                author_in_org = (
+                    "organization" in membership
+                    and args.author_in_org == membership["organization"]["login"]
+                )
+            if not author_in_org:
                 logging.debug(
                     f"PR {pr_number}/{pr_issue_url} author {pr_user_login} is not member of {args.author_in_org}, skipping it"
                 )
                 continue
 
         if args.successful_check is not None:
-            url = f"https://api.github.com/repos/{args.owner}/{args.repo}/statuses/{pr_last_commit_sha}"
-            statuses_filtered = [
-                s
-                for s in _get_all(url, headers=_headers(args))
-                if s["context"] == args.successful_check
-            ]
-            logging.debug(
-                f"PR {pr_number}/{pr_issue_url} have '{args.successful_check}' checks from {', '.join([s['updated_at'] for s in statuses_filtered])}"
-            )
-            if len(statuses_filtered) != 0:
-                status_max = max(statuses_filtered, key=lambda s: s["updated_at"])
+            if "successful_check_status" in pr:
+                status_max = pr["successful_check_status"]
+            else:
+                url = f"https://api.github.com/repos/{args.owner}/{args.repo}/statuses/{pr_last_commit_sha}"
+                status_max = None
+                for s in _get_all(url, headers=headers):
+                    if s["context"] != args.successful_check:
+                        continue
+                    if status_max is None or s["updated_at"] > status_max["updated_at"]:
+                        status_max = s
+            if status_max is not None:
+                logging.debug(
+                    f"PR {pr_number}/{pr_issue_url} latest '{args.successful_check}' check from {status_max['updated_at']} is {status_max['state']}"
+                )
                 if status_max["state"] != "success":
                     logging.debug(
                         f"PR {pr_number}/{pr_issue_url} - {pr_last_commit_sha} does not have expected state, skipping it"
@@ -153,16 +464,15 @@ def load_pr(args):
     url = (
         f"https://api.github.com/repos/{args.owner}/{args.repo}/pulls/{args.pr_number}"
     )
-    response = requests.get(url, headers=_headers(args))
-    pr = response.json()
+    headers = _headers(args)
+    response = _SESSION.get(url, headers=headers)
+    pr = orjson.loads(response.content)
 
     pr_number = pr["number"]
     pr_issue_url = pr["issue_url"]
     pr_updated_at = pr["updated_at"]
 
-    pr_last_commit = [c for c in _get_all(pr["commits_url"], headers=_headers(args))][
-        -1
-    ]
+    pr_last_commit = _get_last(pr["commits_url"], headers=headers)
     pr_last_commit_sha = pr_last_commit["sha"]
 
     print(f"{pr_number} {pr_issue_url} {pr_updated_at} {pr_last_commit_sha}")
@@ -191,7 +501,7 @@ def status_commit(args):
     if "status_target_url" in args:
         data["target_url"] = args.status_target_url
 
-    response = requests.post(url, headers=_headers(args), json=data)
+    response = _SESSION.post(url, headers=_headers(args), json=data)
     if not response.ok:
         raise Exception(
             f"Failed to post to {url}: {response.status_code} {response.text}"
@@ -227,6 +537,16 @@ def main():
         default=None,
         help="Skip PRs that did not passed this check",
     )
+    parser_find_pr.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Stop at first PR that was not updated since it was processed",
+    )
+    parser_find_pr.add_argument(
+        "--graphql",
+        action="store_true",
+        help="Use GraphQL API to get PRs with their authors and checks in one go, needs token",
+    )
 
     parser_load_pr = subparsers.add_parser("load_pr", help="Load details for given PR")
     parser_load_pr.set_defaults(func=load_pr)
@@ -276,7 +596,10 @@ def main():
 
     logging.debug(f"Args: {args}")
 
-    return args.func(args)
+    try:
+        return args.func(args)
+    finally:
+        _dump_etags()
 
 
 if __name__ == "__main__":
@@ -1,52 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import concurrent.futures
 import datetime
 import logging
 import os
 import re
-import subprocess
 import sys
 
-import requests
+import orjson
 
-import json
+import requests
 
 import tabulate
 
+PER_PAGE = 100
+PROW_DOWNLOAD_WORKERS = 4
 
-class _JSONDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        json.JSONDecoder.__init__(self, object_hook=self.object_hook, *args, **kwargs)
-
-    def object_hook(self, obj):
-        ret = {}
-        for key, value in obj.items():
-            if key in {"created_at"}:
-                ret[key] = datetime.datetime.fromisoformat(value)
-            else:
-                ret[key] = value
-        return ret
-
-
-class _JSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (datetime.date, datetime.datetime)):
-            return obj.isoformat()
-        return json.JSONEncoder.default(obj)
-
-
-def _headers(args):
-    headers = {
-        "Accept": "application/vnd.github+json",
-    }
-    if args.token is not None:
-        headers["Authorization"] = f"Bearer {args.token}"
-    return headers
+# Reuse connections (and TLS sessions) across all requests
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept": "application/vnd.github+json"})
+_SESSION.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16),
+)
 
 
 def _post_raw(url, **kwargs):
-    response = requests.post(url, **kwargs)
+    response = _SESSION.post(url, **kwargs)
     if not response.ok:
         raise Exception(
             f"Failed to get reposnse {url}: {response.status_code} {response.text}"
@@ -55,7 +37,7 @@ def _post_raw(url, **kwargs):
 
 
 def _get_raw(url, **kwargs):
-    response = requests.get(url, **kwargs)
+    response = _SESSION.get(url, **kwargs)
     if not response.ok:
         raise Exception(
             f"Failed to get reposnse {url}: {response.status_code} {response.text}"
@@ -63,87 +45,150 @@ def _get_raw(url, **kwargs):
     return response
 
 
-def _json_loads(text):
-    return json.loads(text, cls=_JSONDecoder)
+def _get_all(url, **kwargs):
+    # GitHub defaults to 30 items per page, ask for maximum instead
+    kwargs["params"] = {"per_page": PER_PAGE, **(kwargs.get("params") or {})}
 
+    response = _get_raw(url, **kwargs)
 
-def _json_dumps(data):
-    return json.dumps(data, cls=_JSONEncoder)
+    # Page URLs already contain all the query parameters
+    page_kwargs = {k: v for k, v in kwargs.items() if k != "params"}
 
+    # Fetch next page while caller processes current one, but keep just one
+    # request in flight as GitHub secondary rate limits are strict
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            future = None
+            if "next" in response.links:
+                next_url = response.links["next"]["url"]
+                future = executor.submit(_get_raw, next_url, **page_kwargs)
 
-def _get_all(url, **kwargs):
-    while True:
-        response = _get_raw(url, **kwargs)
+            results = orjson.loads(response.content)
+            logging.debug(f"From {url} got {len(results)} results")
 
-        results = _json_loads(response.text)
-        logging.debug(f"From {url} got {len(results)} results")
+            yield from results
 
-        for r in results:
-            yield r
-
-        if "next" in response.links:
-            url = response.links["next"]["url"]
-        else:
-            break
+            if future is None:
+                break
+            url = next_url
+            response = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def list_commit_statuses_for_reference(args):
     url = f"https://api.github.com/repos/{args.owner}/{args.repo}/commits/{args.commit}/statuses"
-    data = []
-    for response in _get_all(url, headers=_headers(args)):
-        data.append(response)
-    return data
+    return _get_all(url)
 
 
 def get_pull_request(args):
     url = f"https://api.github.com/repos/{args.owner}/{args.repo}/pulls/{args.pull_number}"
-    data = _json_loads(_get_raw(url, headers=_headers(args)).text)
+    data = orjson.loads(_get_raw(url).content)
     return data
 
 
 def create_issue_comment(args):
     url = f"https://api.github.com/repos/{args.owner}/{args.repo}/issues/{args.issue_number}/comments"
-    _post_raw(url, headers=_headers(args), json={"body": args.body})
+    _post_raw(url, json={"body": args.body})
 
 
 def add_comment(args):
     create_issue_comment(args)
 
 
-def _checks_filter(args, data):
-    if args.latest_by_context:
-        data_new = {}
-        for d in data:
-            if d["context"] not in data_new:
-                data_new[d["context"]] = d
-            else:
-                if d["created_at"] > data_new[d["context"]]["created_at"]:
-                    data_new[d["context"]] = d
-        data = list(data_new.values())
+def _created_at(d):
+    # Parse timestamp in place, so every check is parsed at most once
+    if isinstance(d["created_at"], str):
+        d["created_at"] = datetime.datetime.fromisoformat(d["created_at"])
+    return d["created_at"]
 
-    if args.filter_by_state is not None:
-        data = [d for d in data if d["state"] == args.filter_by_state]
 
+def _matcher(pattern):
+    # Plain strings do not need regexp engine, substring test is much faster
+    if re.escape(pattern) == pattern:
+        return lambda text: pattern in text
+    return re.compile(pattern).search
+
+
+def _checks_filter(args, data):
+    context_match = None
     if args.filter_by_context_re is not None:
-        data = [
-            d
-            for d in data
-            if d["context"] is not None
-            and re.search(args.filter_by_context_re, d["context"]) is not None
-        ]
+        context_match = _matcher(args.filter_by_context_re)
 
+    target_url_match = None
     if args.filter_by_target_url_re is not None:
-        data = [
-            d
-            for d in data
-            if d["target_url"] is not None
-            and re.search(args.filter_by_target_url_re, d["target_url"]) is not None
-        ]
+        target_url_match = _matcher(args.filter_by_target_url_re)
 
-    if args.filter_by_created_at_ge is not None:
-        data = [d for d in data if d["created_at"] >= args.filter_by_created_at_ge]
+    def context_matches(d):
+        return context_match is None or (
+            d["context"] is not None and context_match(d["context"])
+        )
 
-    return data
+    def other_matches(d):
+        # Cheapest checks first, so most rows never get to regexps
+        if args.filter_by_state is not None and d["state"] != args.filter_by_state:
+            return False
+        if (
+            args.filter_by_created_at_ge is not None
+            and _created_at(d) < args.filter_by_created_at_ge
+        ):
+            return False
+        if target_url_match is not None and (
+            d["target_url"] is None or not target_url_match(d["target_url"])
+        ):
+            return False
+        return True
+
+    # Context filter gives same result before and after picking latest check
+    # for every context, other filters have to be applied only after that
+    filtered = []
+    latest = {}
+    for d in data:
+        if args.latest_by_context:
+            if not context_matches(d):
+                continue
+            # GitHub timestamps are all in same ISO 8601 format, so they sort
+            # as strings
+            current = latest.get(d["context"])
+            if current is None or d["created_at"] > current["created_at"]:
+                latest[d["context"]] = d
+        elif other_matches(d) and context_matches(d):
+            filtered.append(d)
+
+    if args.latest_by_context:
+        filtered = [d for d in latest.values() if other_matches(d)]
+
+    return filtered
+
+
+async def _prow_download_one(semaphore, runme):
+    async with semaphore:
+        print(f"Downloading: {' '.join(runme)}")
+
+        process = await asyncio.create_subprocess_exec(
+            *runme, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        exit_code = process.returncode
+
+        if exit_code != 0:
+            logging.error(f"Failed to run: '{' '.join(runme)}'")
+            logging.error(f"stdout: {stdout.decode()}")
+            logging.error(f"stderr: {stderr.decode()}")
+            logging.error(f"Exit code: {exit_code}")
+        else:
+            print(f"...finished {' '.join(runme)} with {exit_code}")
+
+        return exit_code
+
+
+async def _prow_download(commands):
+    # Run several downloads at once, each of them is mostly waiting for network
+    semaphore = asyncio.Semaphore(PROW_DOWNLOAD_WORKERS)
+    return await asyncio.gather(
+        *(_prow_download_one(semaphore, runme) for runme in commands)
+    )
 
 
 def list_checks(args):
@@ -156,14 +201,28 @@ def list_checks(args):
 
     fields = ["created_at", "state", "context", "target_url"]
     table = []
+    # Serializing every row just to throw it away is expensive
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     for d in data:
-        logging.debug(f"Processing: {_json_dumps(d)}")
-        row = [d[f] if f in d else None for f in fields]
-        table.append(row)
-    print(tabulate.tabulate(table, headers=fields))
+        _created_at(d)
+        if debug:
+            logging.debug(
+                f"Processing: {orjson.dumps(d, option=orjson.OPT_NAIVE_UTC).decode()}"
+            )
+        table.append(
+            (d["created_at"], d.get("state"), d.get("context"), d.get("target_url"))
+        )
+    if sys.stdout.isatty():
+        print(tabulate.tabulate(table, headers=fields))
+    else:
+        # Nobody reads aligned columns when piped, skip measuring their widths
+        print("\t".join(fields))
+        for row in table:
+            print("\t".join("" if v is None else str(v) for v in row))
 
     if args.prow_download_path is not None:
         print("")
+        commands = []
         for d in data:
             guess_run_id = d["target_url"].split("/")[-1]
             guess_job_name = d["target_url"].split("/")[-2]
@@ -180,22 +239,11 @@ def list_checks(args):
                 f"gs://test-platform-results/pr-logs/pull/{args.owner}_{args.repo}/{args.pull_number}/{guess_job_name}/{guess_run_id}/artifacts/{guess_test_name}/{args.prow_download_path}",
                 f"{guess_run_id}/",
             ]
-            print(f"Downloading: {' '.join(runme)}")
+            commands.append(runme)
 
-            process = subprocess.Popen(
-                runme, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            stdout, stderr = process.communicate()
-            exit_code = process.returncode
-
-            if exit_code != 0:
-                logging.error(f"Failed to run: '{' '.join(runme)}'")
-                logging.error(f"stdout: {stdout.decode()}")
-                logging.error(f"stderr: {stderr.decode()}")
-                logging.error(f"Exit code: {exit_code}")
-                sys.exit(1)
-
-            print(f"...finished with {exit_code}")
+        exit_codes = asyncio.run(_prow_download(commands))
+        if any(exit_code != 0 for exit_code in exit_codes):
+            sys.exit(1)
 
 
 def main():
@@ -256,6 +304,9 @@ def main():
 
     logging.debug(f"Args: {args}")
 
+    if args.token is not None:
+        _SESSION.headers["Authorization"] = f"Bearer {args.token}"
+
     return args.func(args)
 
 